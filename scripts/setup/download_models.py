@@ -7,32 +7,71 @@ TrackieLLM Model Downloader
 This script downloads the required machine learning models for the TrackieLLM
 project from their public hosting locations (like Hugging Face).
 
-It checks for existing files and will not re-download them. A progress bar
-is displayed for large files.
+Existing files are revalidated with a conditional request against the ETag
+and Last-Modified validators saved from the previous download, so unchanged
+models are skipped without transferring any data. All models are
+fetched concurrently from a thread pool sharing a single HTTP session, so the
+total download time is bounded by the largest file rather than the sum of all
+of them. A progress bar is displayed for each file.
+
+Every downloaded file is hashed with XXH3, and the digest is recorded next to
+it. On later runs the file is checked against that digest, so a file that was
+corrupted or truncated on disk is downloaded again instead of being silently
+kept. New downloads are also checked against their expected SHA-256: either
+one pinned in MODELS_TO_DOWNLOAD or, for files on the Hugging Face Hub, the
+digest the Hub publishes for them.
+
+Models hosted on the Hugging Face Hub are fetched through `huggingface_hub`
+with the Rust `hf_transfer` backend when both packages are installed.
 
 Dependencies:
   - requests
   - tqdm
+  - xxhash
+  - huggingface_hub, hf_transfer (optional, for faster Hub downloads)
 
 Install them using:
-  pip install requests tqdm
+  pip install requests tqdm xxhash
   or
   pip install -r requirements.txt (if a requirements file is provided)
 """
 
-import requests
+import errno
+import hashlib
+import importlib.util
+import json
+import mmap
+import os
 import sys
+import tempfile
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
 from pathlib import Path
+from typing import List, Optional, Tuple
+
+import requests
+import xxhash
+from requests.adapters import HTTPAdapter
 from tqdm import tqdm
+from urllib3.util.retry import Retry
 
 # --- Configuration ---
 
 # Define the models to be downloaded.
 # Each entry is a dictionary with the target filename and the download URL.
+# Optional keys:
+#   - "sha256": the expected SHA-256 hex digest of the file. Without it, files
+#     on the Hugging Face Hub are checked against the SHA-256 that the Hub
+#     publishes in the X-Linked-Etag header.
+#   - "hf_repo_id" / "hf_filename": the file's location on the Hugging Face Hub,
+#     used to download it with hf_transfer when available.
 MODELS_TO_DOWNLOAD = [
     {
         "filename": "gemma-2b-it.gguf",
         "url": "https://huggingface.co/TheBloke/gemma-2b-it-GGUF/resolve/main/gemma-2b-it.Q4_K_M.gguf",
+        "hf_repo_id": "TheBloke/gemma-2b-it-GGUF",
+        "hf_filename": "gemma-2b-it.Q4_K_M.gguf",
     },
     {
         "filename": "yolo_v8n.onnx",
@@ -48,60 +87,361 @@ MODELS_TO_DOWNLOAD = [
     },
 ]
 
+# Received chunks are batched up to this size before being written to disk.
+WRITE_BUFFER_SIZE = 1024 * 1024 # 1 MB
+
+# Progress bars are advanced in steps of at least this many bytes, rather
+# than once per received chunk.
+PROGRESS_UPDATE_SIZE = 1024 * 1024 # 1 MB
+
+# Files larger than this are fetched over several parallel ranged requests
+# when the server supports them, to get past per-connection CDN throttling.
+PARALLEL_DOWNLOAD_THRESHOLD = 256 * 1024 * 1024 # 256 MB
+PARALLEL_DOWNLOAD_SEGMENTS = 8
+
 # --- Helper Functions ---
 
+def create_session() -> requests.Session:
+    """
+    Creates an HTTP session that can be shared by all download threads.
+
+    Connections are kept alive and pooled per host, so files served from the
+    same host reuse an established TCP+TLS connection instead of paying for
+    a new handshake. Transient gateway errors are retried with backoff.
+    """
+    session = requests.Session()
+    retries = Retry(total=3, backoff_factor=0.5, status_forcelist=[502, 503, 504])
+    adapter = HTTPAdapter(pool_connections=4, pool_maxsize=16, max_retries=retries)
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    return session
+
+# A single session shared by every download in this process.
+SESSION = create_session()
+
 def get_project_root() -> Path:
     """Finds the project root directory relative to this script's location."""
     return Path(__file__).resolve().parent.parent.parent
 
-def download_file(url: str, dest_path: Path):
+def get_validators_path(dest_path: Path) -> Path:
+    """Returns the path of the sidecar file holding a model's HTTP validators."""
+    return dest_path.with_name(dest_path.name + ".etag")
+
+def load_validators(dest_path: Path) -> dict:
+    """
+    Loads the ETag/Last-Modified validators and XXH3 digest saved for a previously downloaded file.
+
+    Returns an empty dict if the sidecar file is missing or unreadable.
+    """
+    try:
+        with open(get_validators_path(dest_path), 'r') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+def save_validators(dest_path: Path, response: requests.Response, digest: str, sha256: Optional[str] = None):
+    """Persists the ETag/Last-Modified validators and the digests of a completed download."""
+    validators = {
+        "etag": response.headers.get('ETag'),
+        "last_modified": response.headers.get('Last-Modified'),
+        "xxh3": digest,
+        "sha256": sha256,
+    }
+    with open(get_validators_path(dest_path), 'w') as f:
+        json.dump(validators, f, indent=2)
+
+def file_xxh3(path: Path) -> str:
+    """Returns the XXH3-64 hex digest of a file's contents."""
+    digest = xxhash.xxh3_64()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+def file_sha256(path: Path) -> str:
+    """Returns the SHA-256 hex digest of a file's contents."""
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+def hub_sha256(response: requests.Response) -> Optional[str]:
+    """
+    Returns the SHA-256 the Hugging Face Hub publishes for a file, if any.
+
+    For files stored in Git LFS, the Hub's redirect carries the SHA-256 of the
+    content in its X-Linked-Etag header. Other files carry a 40-character git
+    blob hash there, which is not a content digest, so it is ignored.
+    """
+    for hop in (*response.history, response):
+        etag = hop.headers.get('X-Linked-Etag', '')
+        etag = (etag[2:] if etag.startswith('W/') else etag).strip('"').lower()
+        if len(etag) == 64 and all(c in "0123456789abcdef" for c in etag):
+            return etag
+    return None
+
+def hf_transfer_available() -> bool:
+    """Checks whether Hub downloads can use huggingface_hub's Rust hf_transfer backend."""
+    return all(importlib.util.find_spec(name) for name in ("huggingface_hub", "hf_transfer"))
+
+def download_from_hub(repo_id: str, filename: str, dest_path: Path):
+    """Downloads a file from the Hugging Face Hub with hf_transfer's parallel ranged GETs."""
+    # Must be set before huggingface_hub is first imported
+    os.environ["HF_HUB_ENABLE_HF_TRANSFER"] = "1"
+    from huggingface_hub import hf_hub_download
+
+    with tempfile.TemporaryDirectory(dir=dest_path.parent) as staging_dir:
+        downloaded = hf_hub_download(repo_id=repo_id, filename=filename, local_dir=staging_dir)
+        Path(downloaded).replace(dest_path)
+
+def preallocate(fd: int, size: int):
+    """
+    Reserves disk space for a file of a known size, where the platform supports it.
+
+    Preallocating up front lets the filesystem lay the file out contiguously
+    and fails early if the disk is too small for the model.
+    """
+    if size <= 0 or not hasattr(os, 'posix_fallocate'):
+        return
+    try:
+        os.posix_fallocate(fd, 0, size)
+    except OSError as e:
+        if e.errno == errno.ENOSPC:
+            raise
+        # The filesystem does not support preallocation; the file will grow on write.
+
+def write_chunks(fd: int, chunks: List[bytes]):
+    """Writes a batch of chunks to a file descriptor, using a single vectored write if available."""
+    written = os.writev(fd, chunks) if hasattr(os, 'writev') else 0
+    if written == sum(len(chunk) for chunk in chunks):
+        return
+    # Short write: fall back to plain writes for whatever is left.
+    remaining = memoryview(b"".join(chunks))[written:]
+    while remaining:
+        remaining = remaining[os.write(fd, remaining):]
+
+@contextmanager
+def map_file(fd: int, size: int):
+    """
+    Sizes a file and maps it into memory for writing.
+
+    Chunks are copied straight into the mapped page cache, avoiding a write
+    syscall per chunk. On exit, the pages are flushed and released so a large
+    model does not stay resident in this process.
+    """
+    preallocate(fd, size)
+    os.ftruncate(fd, size)
+    with mmap.mmap(fd, size, access=mmap.ACCESS_WRITE) as mm:
+        yield mm
+        mm.flush()
+        if hasattr(mmap, 'MADV_DONTNEED'):
+            mm.madvise(mmap.MADV_DONTNEED)
+
+class DownloadCancelled(Exception):
+    """Raised in a ranged download worker when a sibling range has failed."""
+
+def copy_into_mmap(response: requests.Response, mm: mmap.mmap, start: int, end: int, block_size: int, on_progress,
+                   cancelled: Optional[threading.Event] = None) -> int:
+    """
+    Copies a response body into the mapped region [start, end).
+
+    If `cancelled` is given, the copy stops with `DownloadCancelled` as soon
+    as it is set. Returns the offset one past the last byte written.
+    """
+    offset = reported = start
+    for data in response.iter_content(block_size):
+        if cancelled is not None and cancelled.is_set():
+            raise DownloadCancelled()
+        next_offset = offset + len(data)
+        if next_offset > end:
+            raise IOError(f"Received more than the expected {end - start} bytes.")
+        mm[offset:next_offset] = data
+        offset = next_offset
+        if offset - reported >= PROGRESS_UPDATE_SIZE:
+            on_progress(offset - reported)
+            reported = offset
+    if offset > reported:
+        on_progress(offset - reported)
+    return offset
+
+def stream_to_mmap(response: requests.Response, fd: int, total_size: int, block_size: int, progress_bar: tqdm):
+    """Streams a response body of known size into a file through a memory map of it."""
+    with map_file(fd, total_size) as mm:
+        copy_into_mmap(response, mm, 0, total_size, block_size, progress_bar.update)
+
+def download_range(url: str, mm: mmap.mmap, start: int, end: int, block_size: int, on_progress,
+                   cancelled: threading.Event):
+    """
+    Downloads the byte range [start, end) of a URL into the same region of a mapped file.
+
+    Any failure sets `cancelled`, so the sibling ranges stop at their next
+    chunk instead of finishing their transfers.
+    """
+    headers = {'Range': f"bytes={start}-{end - 1}"}
+    try:
+        # The response is closed on exit, including when the range is cancelled.
+        with SESSION.get(url, headers=headers, stream=True, timeout=30) as response:
+            response.raise_for_status()
+            if response.status_code != 206:
+                raise IOError("Server ignored the Range request.")
+            offset = copy_into_mmap(response, mm, start, end, block_size, on_progress, cancelled)
+        if offset != end:
+            raise IOError(f"Range {start}-{end - 1} ended early at byte {offset}.")
+    except BaseException:
+        cancelled.set()
+        raise
+
+def stream_ranges_to_mmap(url: str, fd: int, total_size: int, block_size: int, progress_bar: tqdm):
+    """
+    Downloads a file of known size as parallel byte ranges, each written to
+    its own region of a memory map of the destination.
+    """
+    progress_lock = threading.Lock()
+    cancelled = threading.Event()
+
+    def on_progress(n: int):
+        with progress_lock:
+            progress_bar.update(n)
+
+    segment_size = -(-total_size // PARALLEL_DOWNLOAD_SEGMENTS) # Ceiling division
+    ranges = [(start, min(start + segment_size, total_size)) for start in range(0, total_size, segment_size)]
+    with map_file(fd, total_size) as mm, ThreadPoolExecutor(max_workers=len(ranges)) as executor:
+        futures = [
+            executor.submit(download_range, url, mm, start, end, block_size, on_progress, cancelled)
+            for start, end in ranges
+        ]
+        # Report the failure that caused the cancellation, not a cancelled sibling
+        errors = [future.exception() for future in futures]
+        for error in errors:
+            if error is not None and not isinstance(error, DownloadCancelled):
+                raise error
+
+def stream_to_fd(response: requests.Response, fd: int, block_size: int, progress_bar: tqdm):
+    """Streams a response body of unknown size into a file in batched vectored writes."""
+    pending, pending_size = [], 0
+    for data in response.iter_content(block_size):
+        pending.append(data)
+        pending_size += len(data)
+        if pending_size >= WRITE_BUFFER_SIZE:
+            write_chunks(fd, pending)
+            progress_bar.update(pending_size)
+            pending, pending_size = [], 0
+    if pending:
+        write_chunks(fd, pending)
+        progress_bar.update(pending_size)
+
+def download_file(url: str, dest_path: Path, position: int = 0, expected_sha256: Optional[str] = None,
+                  hf_file: Optional[Tuple[str, str]] = None):
     """
     Downloads a file from a URL to a destination path with a progress bar.
 
     Args:
         url (str): The URL to download from.
         dest_path (Path): The local path to save the file to.
+        position (int): The line offset of this file's progress bar, so that
+            concurrent downloads do not draw over each other.
+        expected_sha256 (Optional[str]): The pinned SHA-256 hex digest of the
+            file. If not given, the digest published by the Hub is used, if any.
+        hf_file (Optional[Tuple[str, str]]): The (repo_id, filename) of
+            the file on the Hugging Face Hub, if it is hosted there.
     """
+    headers = {}
     if dest_path.exists() and dest_path.stat().st_size > 0:
-        print(f"  -> File already exists: {dest_path.name}. Skipping.")
-        return
+        validators = load_validators(dest_path)
+        if validators.get("xxh3") and file_xxh3(dest_path) != validators["xxh3"]:
+            print(f"  -> {dest_path.name} failed its integrity check. Downloading it again.")
+        elif expected_sha256 and (validators.get("sha256") or file_sha256(dest_path)) != expected_sha256:
+            print(f"  -> {dest_path.name} does not match its pinned SHA-256. Downloading it again.")
+        elif not (validators.get("etag") or validators.get("last_modified")):
+            # No validators were recorded for this file; nothing to compare against.
+            print(f"  -> File already exists: {dest_path.name}. Skipping.")
+            return
+        else:
+            if validators.get("etag"):
+                headers['If-None-Match'] = validators["etag"]
+            if validators.get("last_modified"):
+                headers['If-Modified-Since'] = validators["last_modified"]
+
+    # Download into a temporary file so an existing model is only replaced
+    # once its update has been fully received.
+    part_path = dest_path.with_name(dest_path.name + ".part")
 
     print(f"  -> Downloading {dest_path.name} from {url}...")
     try:
-        response = requests.get(url, stream=True, timeout=30)
+        response = SESSION.get(url, headers=headers, stream=True, timeout=30)
+        if response.status_code == 304:
+            response.close()
+            print(f"  -> File is up to date: {dest_path.name}. Skipping.")
+            return
         response.raise_for_status()  # Raise an exception for bad status codes (4xx or 5xx)
 
-        total_size_in_bytes = int(response.headers.get('content-length', 0))
-        block_size = 1024 * 8 # 8 KB
+        if hf_file is not None and hf_transfer_available():
+            # The Hub download replaces this response's body; it was only
+            # needed to revalidate the file and record its validators.
+            response.close()
+            download_from_hub(*hf_file, part_path)
+        else:
+            total_size_in_bytes = int(response.headers.get('content-length', 0))
+            block_size = 1024 * 256 # 256 KB
+            use_ranges = (
+                total_size_in_bytes > PARALLEL_DOWNLOAD_THRESHOLD
+                and response.headers.get('Accept-Ranges') == 'bytes'
+            )
+            if use_ranges:
+                # The ranged requests replace this response's body; fetch them from
+                # the final (post-redirect) URL to skip a redirect per range.
+                response.close()
+
+            progress_bar = tqdm(
+                total=total_size_in_bytes,
+                unit='iB',
+                unit_scale=True,
+                desc=f"     {dest_path.name}",
+                position=position,
+                mininterval=0.5, # Throttle redraws independently of update frequency
+                maxinterval=2.0,
+            )
 
-        progress_bar = tqdm(
-            total=total_size_in_bytes,
-            unit='iB',
-            unit_scale=True,
-            desc=f"     {dest_path.name}"
-        )
+            # Mapping a file for writing requires it to be opened read/write.
+            fd = os.open(part_path, os.O_RDWR | os.O_CREAT | os.O_TRUNC | getattr(os, 'O_BINARY', 0), 0o644)
+            try:
+                if use_ranges:
+                    stream_ranges_to_mmap(response.url, fd, total_size_in_bytes, block_size, progress_bar)
+                elif total_size_in_bytes > 0:
+                    stream_to_mmap(response, fd, total_size_in_bytes, block_size, progress_bar)
+                else:
+                    stream_to_fd(response, fd, block_size, progress_bar)
+            finally:
+                os.close(fd)
 
-        with open(dest_path, 'wb') as file:
-            for data in response.iter_content(block_size):
-                progress_bar.update(len(data))
-                file.write(data)
+            progress_bar.close()
 
-        progress_bar.close()
+            if total_size_in_bytes != 0 and progress_bar.n != total_size_in_bytes:
+                print(f"  -> ERROR: Download failed for {dest_path.name}. Size mismatch.", file=sys.stderr)
+                part_path.unlink() # Clean up partial download
+                return
 
-        if total_size_in_bytes != 0 and progress_bar.n != total_size_in_bytes:
-            print(f"  -> ERROR: Download failed for {dest_path.name}. Size mismatch.", file=sys.stderr)
-            dest_path.unlink() # Clean up partial download
-        else:
-            print(f"  -> Successfully downloaded {dest_path.name}.")
+        reference_sha256 = expected_sha256 or hub_sha256(response)
+        sha256 = file_sha256(part_path) if reference_sha256 else None
+        if sha256 != reference_sha256:
+            print(f"  -> ERROR: Download failed for {dest_path.name}. Checksum mismatch.", file=sys.stderr)
+            part_path.unlink() # Clean up corrupted download
+            return
+
+        digest = file_xxh3(part_path)
+        part_path.replace(dest_path)
+        save_validators(dest_path, response, digest, sha256)
+        print(f"  -> Successfully downloaded {dest_path.name}.")
 
     except requests.exceptions.RequestException as e:
         print(f"\n  -> ERROR: Could not download {dest_path.name}. Reason: {e}", file=sys.stderr)
-        if dest_path.exists():
-            dest_path.unlink() # Clean up partial download
+        if part_path.exists():
+            part_path.unlink() # Clean up partial download
     except Exception as e:
         print(f"\n  -> An unexpected error occurred: {e}", file=sys.stderr)
-        if dest_path.exists():
-            dest_path.unlink()
+        if part_path.exists():
+            part_path.unlink()
 
 # --- Main Execution ---
 
@@ -118,14 +458,24 @@ def main():
     print(f"Ensuring model directory exists: {models_dir}")
     models_dir.mkdir(parents=True, exist_ok=True)
 
-    # 2. Iterate through the list of models and download each one.
+    # 2. Download all models concurrently. The work is I/O-bound and socket
+    #    reads release the GIL, so one thread per model is enough to overlap
+    #    the transfers.
     print("\nChecking and downloading models...")
-    for model_info in MODELS_TO_DOWNLOAD:
-        filename = model_info["filename"]
-        url = model_info["url"]
-        destination = models_dir / filename
-
-        download_file(url, destination)
+    with ThreadPoolExecutor(max_workers=len(MODELS_TO_DOWNLOAD)) as executor:
+        futures = [
+            executor.submit(
+                download_file,
+                model_info["url"],
+                models_dir / model_info["filename"],
+                i,
+                model_info.get("sha256"),
+                (model_info["hf_repo_id"], model_info["hf_filename"]) if "hf_repo_id" in model_info else None,
+            )
+            for i, model_info in enumerate(MODELS_TO_DOWNLOAD)
+        ]
+        for future in futures:
+            future.result()
 
     print("\n--- Model download process complete. ---")
     print("Please verify that all models were downloaded successfully into the assets/models/ directory.")
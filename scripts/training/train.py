@@ -8,28 +8,38 @@ This script provides tools for personalizing the TrackieLLM experience.
 It is intended to be run on a development machine with more resources
 (and potentially a GPU) than the target embedded device.
 
-It supports two main commands:
+It supports three main commands:
 1. `add-face`:   Registers a new person's face by capturing images from a
                  webcam, extracting facial embeddings, and saving them to a
                  database.
-2. `finetune-llm`: Performs instruction-based fine-tuning on the base LLM
+2. `quantize-embedder`: Converts the face embedding model to INT8 using
+                        post-training static quantization, calibrated on a
+                        directory of face images.
+3. `finetune-llm`: Performs instruction-based fine-tuning on the base LLM
                    (e.g., Gemma) using a custom dataset. This adapts the
                    model's responses to a specific user's preferences.
 
 Dependencies:
-  - torch, transformers, peft, accelerate, bitsandbytes (for LLM fine-tuning)
-  - onnxruntime, numpy, opencv-python (for face processing)
+  - torch, transformers, peft, trl, accelerate, bitsandbytes (for LLM fine-tuning)
+  - onnxruntime, numpy, opencv-python, orjson (for face processing)
 """
 
 import argparse
-import json
+import hashlib
+import importlib.util
+import io
+import os
+import queue
+import re
+import shutil
 import sys
-import time
+import threading
 from pathlib import Path
 
 import cv2
 import numpy as np
 import onnxruntime as ort
+import orjson
 from tqdm import tqdm
 
 # --- Configuration ---
@@ -37,122 +47,326 @@ from tqdm import tqdm
 PROJECT_ROOT = Path(__file__).resolve().parent.parent.parent
 ASSETS_DIR = PROJECT_ROOT / "assets"
 MODELS_DIR = ASSETS_DIR / "models"
-FACES_DB_PATH = ASSETS_DIR / "faces_db" / "known_faces.dat"
+FACES_DB_DIR = ASSETS_DIR / "faces_db"
+FACES_INDEX_PATH = FACES_DB_DIR / "known_faces_index.json" # [{"name": ..., "row": ..., "embedder": ..., "preprocessing": ...}]
+FACES_EMBEDDINGS_PATH = FACES_DB_DIR / "known_faces.npy" # (N, EMBEDDING_SIZE) float16 matrix
+LEGACY_FACES_DB_PATH = FACES_DB_DIR / "known_faces.dat" # JSON database used by older versions
 FINETUNE_DATASET_PATH = PROJECT_ROOT / "scripts" / "training" / "finetune_dataset.json"
+FINETUNE_CACHE_DIR = PROJECT_ROOT / "finetuned_models" / "tokenized_datasets"
+FINETUNE_MAX_SEQ_LENGTH = 1024 # Longer training examples are truncated
+FINETUNE_CACHE_VERSION = 2 # Bump whenever the prompt format changes, to invalidate tokenized caches
 
 # --- Face Processing Globals ---
 FACE_DETECTOR_MODEL = MODELS_DIR / "yolo_v8n.onnx" # Using YOLO for face detection
 FACE_EMBEDDER_MODEL = MODELS_DIR / "mobilefacenet.onnx"
+FACE_EMBEDDER_INT8_MODEL = MODELS_DIR / "mobilefacenet_int8.onnx" # Created by 'quantize-embedder'
 EMBEDDING_SIZE = 128 # MobileFaceNet produces a 128-dimensional vector
+EMBEDDING_BATCH_SIZE = 8 # Face crops are embedded in batches of this size
+FACE_PREPROCESSING_VERSION = 2 # Bump whenever preprocess_face changes; version 2 feeds RGB instead of BGR
+
+# A face sample is only accepted if it is sharp and the face is holding still.
+MIN_FACE_SHARPNESS = 80.0 # Minimum variance of the Laplacian over the face crop
+MAX_FACE_CENTER_SHIFT = 5 # Maximum movement of the box center between frames, in pixels
+
+# Execution providers in order of preference. Providers that are not available
+# in the installed onnxruntime build are skipped, so CPU is always the fallback.
+# TensorRT engines are cached on disk, so they are only built on the first run.
+TRT_ENGINE_CACHE_DIR = MODELS_DIR / "trt_cache"
+ONNX_PROVIDERS = [
+    ("TensorrtExecutionProvider", {
+        "trt_fp16_enable": True,
+        "trt_engine_cache_enable": True,
+        "trt_engine_cache_path": str(TRT_ENGINE_CACHE_DIR),
+    }),
+    ("CUDAExecutionProvider", {"cudnn_conv_algo_search": "EXHAUSTIVE"}),
+    "CPUExecutionProvider",
+]
 
 # --- Helper Functions & Classes ---
 
 def get_onnx_session(model_path: Path) -> ort.InferenceSession:
-    """Initializes and returns an ONNX Runtime inference session."""
+    """
+    Initializes and returns an ONNX Runtime inference session.
+
+    The session uses the fastest available execution provider (TensorRT with
+    FP16 kernels, then CUDA, then CPU) with all graph optimizations enabled.
+    Built TensorRT engines are reused from TRT_ENGINE_CACHE_DIR.
+    """
     if not model_path.exists():
         raise FileNotFoundError(f"Model not found at {model_path}. Please run download_models.py.")
-    return ort.InferenceSession(str(model_path))
+
+    session_options = ort.SessionOptions()
+    session_options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+    session_options.intra_op_num_threads = os.cpu_count() or 0
+    session_options.add_session_config_entry("session.intra_op.allow_spinning", "1")
+
+    available = set(ort.get_available_providers())
+    providers = [p for p in ONNX_PROVIDERS if (p[0] if isinstance(p, tuple) else p) in available]
+    if "TensorrtExecutionProvider" in available:
+        TRT_ENGINE_CACHE_DIR.mkdir(exist_ok=True)
+    return ort.InferenceSession(str(model_path), session_options, providers=providers)
 
 class FaceProcessor:
     """Encapsulates face detection and embedding extraction."""
-    def __init__(self):
+    def __init__(self, embedder_model: Path | None = None):
         print("Initializing Face Processor...")
+        if embedder_model is None:
+            # Prefer the INT8 embedder when it has been generated
+            embedder_model = FACE_EMBEDDER_INT8_MODEL if FACE_EMBEDDER_INT8_MODEL.exists() else FACE_EMBEDDER_MODEL
         self.detector = get_onnx_session(FACE_DETECTOR_MODEL)
-        self.embedder = get_onnx_session(FACE_EMBEDDER_MODEL)
+        self.embedder = get_onnx_session(embedder_model)
+        self.embedder_name = embedder_model.name # Recorded with each registered face
         self.detector_input_name = self.detector.get_inputs()[0].name
         self.embedder_input_name = self.embedder.get_inputs()[0].name
         self.detector_input_shape = self.detector.get_inputs()[0].shape[2:] # H, W
         self.embedder_input_shape = self.embedder.get_inputs()[0].shape[2:] # H, W
+        self.det_h, self.det_w = (int(dim) for dim in self.detector_input_shape)
+        self.embedder_size = (int(self.embedder_input_shape[1]), int(self.embedder_input_shape[0])) # W, H
+        # Letterbox canvas and geometry, reused across frames as long as the frame size is unchanged
+        self._padded = np.full((self.det_h, self.det_w, 3), 128, dtype=np.uint8)
+        self._letterbox = None # ((h, w), resized_w, resized_h, 1 / scale)
+        # Models exported with FP16 inputs (for GPU inference) must be fed FP16 tensors
+        self.embedder_input_dtype = np.float16 if self.embedder.get_inputs()[0].type == "tensor(float16)" else np.float32
+        # Models exported with a static batch axis can only be run that many crops at a time
+        batch_dim = self.embedder.get_inputs()[0].shape[0]
+        self.embedder_batch_size = batch_dim if isinstance(batch_dim, int) else None
 
     def detect_largest_face(self, frame: np.ndarray) -> tuple[int, int, int, int] | None:
-        """Detects faces in a frame and returns the bounding box of the largest one."""
-        # Preprocess for YOLO
+        """
+        Detects faces in a frame and returns the bounding box of the largest one.
+
+        The box is clipped to the frame and never empty.
+        """
+        # Preprocess for YOLO: letterbox the frame into the reused padded canvas
         h, w, _ = frame.shape
-        scale = min(self.detector_input_shape[0] / h, self.detector_input_shape[1] / w)
-        resized_w, resized_h = int(w * scale), int(h * scale)
-        resized_frame = cv2.resize(frame, (resized_w, resized_h))
-        padded_frame = np.full((self.detector_input_shape[0], self.detector_input_shape[1], 3), 128, dtype=np.uint8)
-        padded_frame[:resized_h, :resized_w] = resized_frame
-        
-        input_tensor = padded_frame.astype(np.float32) / 255.0
-        input_tensor = np.transpose(input_tensor, (2, 0, 1))
-        input_tensor = np.expand_dims(input_tensor, axis=0)
+        if self._letterbox is None or self._letterbox[0] != (h, w):
+            scale = min(self.det_h / h, self.det_w / w)
+            self._letterbox = ((h, w), int(w * scale), int(h * scale), 1.0 / scale)
+            self._padded[:] = 128
+        _, resized_w, resized_h, inv_scale = self._letterbox
+        self._padded[:resized_h, :resized_w] = cv2.resize(frame, (resized_w, resized_h))
+
+        # Scale to [0, 1], convert BGR to RGB and HWC to NCHW in a single pass
+        input_tensor = cv2.dnn.blobFromImage(self._padded, scalefactor=1/255.0, swapRB=True)
 
         # Run YOLO detector
         outputs = self.detector.run(None, {self.detector_input_name: input_tensor})
         
         # Post-process to find the face with the largest area (assuming person class is 0)
         # This is a simplified post-processing. A real one would be more complex.
-        boxes = []
-        for i in range(outputs[0].shape[2]):
-            class_id = np.argmax(outputs[0][0, 4:, i])
-            confidence = outputs[0][0, 4+class_id, i]
-            if class_id == 0 and confidence > 0.6: # Class 0 is 'person' in COCO
-                cx, cy, bw, bh = outputs[0][0, 0:4, i]
-                x1 = int((cx - bw/2) / scale)
-                y1 = int((cy - bh/2) / scale)
-                x2 = int((cx + bw/2) / scale)
-                y2 = int((cy + bh/2) / scale)
-                boxes.append((x1, y1, x2, y2, (x2-x1)*(y2-y1)))
-        
-        if not boxes:
+        # The output has shape (1, 4 + num_classes, num_candidates); all candidates
+        # are filtered at once rather than one at a time.
+        predictions = outputs[0][0]
+        class_scores = predictions[4:]
+        class_ids = class_scores.argmax(axis=0)
+        confidences = class_scores[class_ids, np.arange(class_scores.shape[1])]
+        keep = (class_ids == 0) & (confidences > 0.6) # Class 0 is 'person' in COCO
+        if not keep.any():
             return None
-        
+
+        cx, cy, bw, bh = predictions[0:4, keep]
+        # Boxes are clipped to the frame so callers can always crop with them
+        x1 = np.clip(((cx - bw/2) * inv_scale).astype(np.int64), 0, w)
+        y1 = np.clip(((cy - bh/2) * inv_scale).astype(np.int64), 0, h)
+        x2 = np.clip(((cx + bw/2) * inv_scale).astype(np.int64), 0, w)
+        y2 = np.clip(((cy + bh/2) * inv_scale).astype(np.int64), 0, h)
+
         # Return the box with the largest area
-        largest_box = max(boxes, key=lambda item: item[4])
-        return largest_box[:4]
+        areas = (x2 - x1) * (y2 - y1)
+        largest = np.argmax(areas)
+        if areas[largest] <= 0:
+            return None
+        return int(x1[largest]), int(y1[largest]), int(x2[largest]), int(y2[largest])
 
-    def get_embedding(self, frame: np.ndarray, box: tuple[int, int, int, int]) -> np.ndarray:
-        """Extracts a facial embedding from a cropped and aligned face."""
+    def preprocess_face(self, frame: np.ndarray, box: tuple[int, int, int, int]) -> np.ndarray:
+        """Crops a face from a frame and converts it into a (3, H, W) embedder input."""
         x1, y1, x2, y2 = box
         face_crop = frame[y1:y2, x1:x2]
-        
-        # Preprocess for MobileFaceNet
-        resized_face = cv2.resize(face_crop, self.embedder_input_shape)
-        input_tensor = resized_face.astype(np.float32)
-        input_tensor = (input_tensor - 127.5) / 128.0 # Normalize
-        input_tensor = np.transpose(input_tensor, (2, 0, 1))
-        input_tensor = np.expand_dims(input_tensor, axis=0)
-
-        # Run embedder
-        embedding = self.embedder.run(None, {self.embedder_input_name: input_tensor})[0][0]
-        
-        # L2-normalize the embedding
-        norm = np.linalg.norm(embedding)
-        return embedding / norm
+
+        # Preprocess for MobileFaceNet: resize, normalize to (x - 127.5) / 128,
+        # convert BGR to RGB and HWC to NCHW in a single pass
+        input_tensor = cv2.dnn.blobFromImage(
+            face_crop,
+            scalefactor=1/128.0,
+            size=self.embedder_size,
+            mean=(127.5, 127.5, 127.5),
+            swapRB=True,
+        )
+        return input_tensor[0].astype(self.embedder_input_dtype, copy=False)
+
+    @staticmethod
+    def face_sharpness(frame: np.ndarray, box: tuple[int, int, int, int]) -> float:
+        """Measures the sharpness of a face crop as the variance of its Laplacian."""
+        x1, y1, x2, y2 = box
+        face_crop = frame[y1:y2, x1:x2]
+        gray = cv2.cvtColor(face_crop, cv2.COLOR_BGR2GRAY)
+        return float(cv2.Laplacian(gray, cv2.CV_32F).var())
+
+    def get_embeddings(self, face_tensors: list[np.ndarray]) -> np.ndarray:
+        """
+        Extracts L2-normalized facial embeddings from preprocessed face crops.
+
+        The crops are run through the embedder as a single batch. If the model
+        was exported with a static batch axis, it is run in batches of that size,
+        and a short final batch is zero-padded and the padded rows are dropped.
+        """
+        batch = np.stack(face_tensors)
+        count = len(batch)
+        step = self.embedder_batch_size or count
+        if count % step:
+            padding = np.zeros((step - count % step, *batch.shape[1:]), dtype=batch.dtype)
+            batch = np.concatenate([batch, padding])
+        embeddings = np.concatenate([
+            self.embedder.run(None, {self.embedder_input_name: batch[i:i + step]})[0]
+            for i in range(0, len(batch), step)
+        ])[:count]
+
+        # L2-normalize the embeddings
+        embeddings /= np.linalg.norm(embeddings, axis=1, keepdims=True)
+        return embeddings
+
+class FrameGrabber:
+    """
+    Reads webcam frames on a background thread.
+
+    Capture and decode overlap with inference on the main thread. Only the
+    most recent frames are kept, so the consumer never works on a stale,
+    buffered frame.
+    """
+    def __init__(self, cap: cv2.VideoCapture, max_buffered: int = 2):
+        self.cap = cap
+        self._frames = queue.Queue(maxsize=max_buffered)
+        self._stopped = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def start(self):
+        self._thread.start()
+
+    def _run(self):
+        while not self._stopped.is_set():
+            ret, frame = self.cap.read()
+            if not ret:
+                break
+            # Drop the oldest frame when the consumer falls behind
+            try:
+                self._frames.put_nowait(frame)
+            except queue.Full:
+                try:
+                    self._frames.get_nowait()
+                except queue.Empty:
+                    pass
+                self._frames.put_nowait(frame)
+
+    def read(self) -> np.ndarray | None:
+        """Returns the next frame, or None once the camera stops producing frames."""
+        while True:
+            try:
+                return self._frames.get(timeout=0.1)
+            except queue.Empty:
+                if not self._thread.is_alive():
+                    return None
+
+    def stop(self):
+        self._stopped.set()
+        self._thread.join()
+        self.cap.release()
+
+def write_file_atomic(path: Path, data: bytes):
+    """Writes a file through a temporary sibling so a crash never leaves it truncated."""
+    tmp_path = path.with_name(path.name + ".tmp")
+    tmp_path.write_bytes(data)
+    os.replace(tmp_path, path)
+
+def file_digest(path: Path) -> str:
+    """Returns the SHA-256 hex digest of a file's contents."""
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+def load_face_db() -> tuple[list[dict], np.ndarray]:
+    """
+    Loads the face database as a name index and an embedding matrix.
+
+    Row `i` of the matrix holds the L2-normalized embedding of the index
+    entry whose "row" is `i`. A legacy JSON database is converted on load.
+    Its entries carry no preprocessing version, so they are reported as
+    needing re-registration.
+    """
+    if FACES_INDEX_PATH.exists():
+        index = orjson.loads(FACES_INDEX_PATH.read_bytes())
+        embeddings = np.load(FACES_EMBEDDINGS_PATH)
+    elif LEGACY_FACES_DB_PATH.exists():
+        users = orjson.loads(LEGACY_FACES_DB_PATH.read_bytes())["users"]
+        print(f"WARNING: Converting the legacy database {LEGACY_FACES_DB_PATH.name}. Its embeddings may have been")
+        print("computed with different preprocessing and may not match faces registered from now on.")
+        index = [{"name": user["name"], "row": i} for i, user in enumerate(users)]
+        embeddings = np.array([user["embedding"] for user in users], dtype=np.float32).reshape(-1, EMBEDDING_SIZE)
+        embeddings /= np.linalg.norm(embeddings, axis=1, keepdims=True)
+        embeddings = embeddings.astype(np.float16)
+    else:
+        index = []
+        embeddings = np.empty((0, EMBEDDING_SIZE), dtype=np.float16)
+    return index, embeddings
+
+def save_face_db(index: list[dict], embeddings: np.ndarray):
+    """Saves the face database in the format read by `load_face_db`."""
+    buffer = io.BytesIO()
+    np.save(buffer, embeddings)
+    # The matrix is written first, so the index never refers to missing rows.
+    write_file_atomic(FACES_EMBEDDINGS_PATH, buffer.getvalue())
+    write_file_atomic(FACES_INDEX_PATH, orjson.dumps(index, option=orjson.OPT_INDENT_2))
 
 # --- Command Handlers ---
 
 def handle_add_face(args):
     """Handler for the 'add-face' command."""
     print(f"--- Registering a new face for: {args.name} ---")
-    FACES_DB_PATH.parent.mkdir(exist_ok=True)
+    FACES_DB_DIR.mkdir(exist_ok=True)
 
     # Load existing database or create a new one
-    if FACES_DB_PATH.exists():
-        with open(FACES_DB_PATH, 'r') as f:
-            face_db = json.load(f)
-    else:
-        face_db = {"users": []}
+    face_index, face_embeddings = load_face_db()
+
+    processor = FaceProcessor()
 
-    if any(user['name'] == args.name for user in face_db['users']):
+    # Embeddings computed by another embedder or with other preprocessing do not
+    # match new ones, so those faces have to be registered again, replacing their old entries
+    stale = [
+        entry['name'] for entry in face_index
+        if entry.get('embedder') != processor.embedder_name or entry.get('preprocessing') != FACE_PREPROCESSING_VERSION
+    ]
+    if stale:
+        print(f"WARNING: These faces were not registered with the current embedder ({processor.embedder_name})")
+        print(f"and may no longer be recognized: {', '.join(stale)}")
+        print("Register each of them again with 'add-face' to replace the old entry.")
+
+    existing = next((entry for entry in face_index if entry['name'] == args.name), None)
+    if existing is not None and existing['name'] not in stale:
         print(f"ERROR: A user named '{args.name}' already exists in the database.")
         sys.exit(1)
 
-    processor = FaceProcessor()
     cap = cv2.VideoCapture(0)
     if not cap.isOpened():
         print("ERROR: Cannot open webcam.")
         sys.exit(1)
 
+    grabber = FrameGrabber(cap)
+    grabber.start()
+
     print("\nWebcam opened. Please look at the camera.")
     print(f"Collecting {args.samples} face samples. Press 'q' to quit.")
 
-    embeddings = []
+    # Embeddings are summed as they are produced; only the mean is kept
+    embedding_sum = np.zeros(EMBEDDING_SIZE, dtype=np.float32)
+    embedding_count = 0
+    face_tensors = [] # Preprocessed crops waiting to be embedded
+    samples = 0
+    previous_center = None
     pbar = tqdm(total=args.samples, desc="Capturing samples")
-    while len(embeddings) < args.samples:
-        ret, frame = cap.read()
-        if not ret:
+    while samples < args.samples:
+        frame = grabber.read()
+        if frame is None:
             break
 
         display_frame = frame.copy()
@@ -161,61 +375,152 @@ def handle_add_face(args):
         if box:
             x1, y1, x2, y2 = box
             cv2.rectangle(display_frame, (x1, y1), (x2, y2), (0, 255, 0), 2)
-            
-            # Add a small delay and check for stability to avoid blurry images
-            time.sleep(0.1)
-            
-            embedding = processor.get_embedding(frame, box)
-            embeddings.append(embedding.tolist())
-            pbar.update(1)
+
+            # Only keep samples where the face is still and in focus, to avoid blurry images
+            center = ((x1 + x2) / 2, (y1 + y2) / 2)
+            is_still = (
+                previous_center is not None
+                and abs(center[0] - previous_center[0]) < MAX_FACE_CENTER_SHIFT
+                and abs(center[1] - previous_center[1]) < MAX_FACE_CENTER_SHIFT
+            )
+            previous_center = center
+
+            if is_still and processor.face_sharpness(frame, box) > MIN_FACE_SHARPNESS:
+                face_tensors.append(processor.preprocess_face(frame, box))
+                samples += 1
+                pbar.update(1)
+
+                if len(face_tensors) == EMBEDDING_BATCH_SIZE:
+                    embedding_sum += processor.get_embeddings(face_tensors).sum(axis=0)
+                    embedding_count += len(face_tensors)
+                    face_tensors.clear()
+        else:
+            previous_center = None
 
         cv2.imshow('Face Registration - Press "q" to quit', display_frame)
         if cv2.waitKey(1) & 0xFF == ord('q'):
             break
     
     pbar.close()
-    cap.release()
+    grabber.stop()
     cv2.destroyAllWindows()
 
-    if len(embeddings) < args.samples:
+    if samples < args.samples:
         print("\nRegistration cancelled or not enough samples collected.")
         return
 
+    if face_tensors:
+        embedding_sum += processor.get_embeddings(face_tensors).sum(axis=0)
+        embedding_count += len(face_tensors)
+
     # Average the embeddings to get a single, robust representation
-    avg_embedding = np.mean(np.array(embeddings), axis=0)
-    
-    # Add new user to the database
-    new_user = {"name": args.name, "embedding": avg_embedding.tolist()}
-    face_db["users"].append(new_user)
+    avg_embedding = embedding_sum / embedding_count
+    avg_embedding /= np.linalg.norm(avg_embedding)
+
+    # Add the new user to the database, or replace their outdated embedding
+    if existing is not None:
+        face_embeddings[existing['row']] = avg_embedding
+        existing.update(embedder=processor.embedder_name, preprocessing=FACE_PREPROCESSING_VERSION)
+    else:
+        face_index.append({
+            "name": args.name,
+            "row": len(face_embeddings),
+            "embedder": processor.embedder_name,
+            "preprocessing": FACE_PREPROCESSING_VERSION,
+        })
+        face_embeddings = np.vstack([face_embeddings, avg_embedding.astype(np.float16)])
 
     # Save the updated database
-    with open(FACES_DB_PATH, 'w') as f:
-        json.dump(face_db, f, indent=2)
+    save_face_db(face_index, face_embeddings)
+
+    print(f"\nSuccessfully registered '{args.name}' with {embedding_count} samples.")
+    print(f"Database saved to {FACES_DB_DIR}")
 
-    print(f"\nSuccessfully registered '{args.name}' with {len(embeddings)} samples.")
-    print(f"Database saved to {FACES_DB_PATH}")
+def handle_quantize_embedder(args):
+    """Handler for the 'quantize-embedder' command."""
+    print("--- Quantizing the Face Embedder to INT8 ---")
+    from onnxruntime.quantization import CalibrationDataReader, QuantFormat, QuantType, quantize_static
+
+    if not args.calibration_dir.is_dir():
+        print(f"ERROR: Calibration directory not found: {args.calibration_dir}")
+        sys.exit(1)
+
+    image_paths = sorted(p for p in args.calibration_dir.iterdir() if p.suffix.lower() in (".jpg", ".jpeg", ".png"))
+    if not image_paths:
+        print(f"ERROR: No calibration images (.jpg, .jpeg, .png) found in {args.calibration_dir}")
+        sys.exit(1)
+
+    # Calibrate on the same face crops the embedder sees during registration
+    processor = FaceProcessor(embedder_model=FACE_EMBEDDER_MODEL)
+    face_tensors = []
+    for image_path in tqdm(image_paths, desc="Preparing calibration data"):
+        frame = cv2.imread(str(image_path))
+        box = processor.detect_largest_face(frame) if frame is not None else None
+        if box:
+            face_tensors.append(processor.preprocess_face(frame, box))
+
+    if not face_tensors:
+        print("ERROR: No faces were detected in the calibration images.")
+        sys.exit(1)
+
+    class FaceCalibrationReader(CalibrationDataReader):
+        """Feeds the preprocessed face crops to the quantizer one at a time."""
+        def __init__(self, tensors: list[np.ndarray]):
+            self._tensors = iter(tensors)
+
+        def get_next(self) -> dict | None:
+            tensor = next(self._tensors, None)
+            return None if tensor is None else {processor.embedder_input_name: tensor[np.newaxis]}
+
+    print(f"Calibrating with {len(face_tensors)} face crops...")
+    quantize_static(
+        model_input=str(FACE_EMBEDDER_MODEL),
+        model_output=str(FACE_EMBEDDER_INT8_MODEL),
+        calibration_data_reader=FaceCalibrationReader(face_tensors),
+        quant_format=QuantFormat.QDQ,
+        per_channel=True,
+        activation_type=QuantType.QUInt8,
+        weight_type=QuantType.QInt8,
+    )
+
+    print(f"INT8 embedder saved to {FACE_EMBEDDER_INT8_MODEL}")
+    print("It will be used automatically by 'add-face', which will list the faces registered")
+    print("with the FP32 embedder so they can be registered again.")
 
 def handle_finetune_llm(args):
     """Handler for the 'finetune-llm' command."""
     print("--- Fine-tuning the Language Model ---")
     try:
         import torch
-        from transformers import AutoTokenizer, AutoModelForCausalLM, TrainingArguments, Trainer, DataCollatorForLanguageModeling
+        from transformers import AutoTokenizer, AutoModelForCausalLM, BitsAndBytesConfig
         from peft import LoraConfig, get_peft_model, prepare_model_for_kbit_training
-        from datasets import Dataset
+        from trl import SFTConfig, SFTTrainer
+        from datasets import Dataset, load_from_disk
+        import ijson
     except ImportError:
-        print("ERROR: LLM fine-tuning requires PyTorch, transformers, peft, accelerate, bitsandbytes, and datasets.")
-        print("Please install them: pip install torch transformers peft accelerate bitsandbytes datasets")
+        print("ERROR: LLM fine-tuning requires PyTorch, transformers, peft, trl, accelerate, bitsandbytes, datasets, and ijson.")
+        print("Please install them: pip install torch transformers peft trl accelerate bitsandbytes datasets ijson")
         sys.exit(1)
 
     # 1. Load Model and Tokenizer
     model_name = args.base_model
     print(f"Loading base model: {model_name}")
     
-    # Use 4-bit quantization for memory efficiency
+    # Use 4-bit NF4 quantization for memory efficiency, and the fused
+    # FlashAttention-2 kernel when the flash-attn package is installed
+    attn_implementation = "flash_attention_2" if importlib.util.find_spec("flash_attn") else "sdpa"
+    # Packed examples are only kept from attending to each other by FlashAttention-2
+    use_packing = attn_implementation == "flash_attention_2"
+    if not use_packing:
+        print("WARNING: flash-attn is not installed; sequence packing is disabled and examples will be padded.")
     model = AutoModelForCausalLM.from_pretrained(
         model_name,
-        load_in_4bit=True,
+        quantization_config=BitsAndBytesConfig(
+            load_in_4bit=True,
+            bnb_4bit_quant_type="nf4",
+            bnb_4bit_compute_dtype=torch.bfloat16,
+        ),
+        attn_implementation=attn_implementation,
         torch_dtype=torch.bfloat16,
         device_map="auto",
     )
@@ -240,22 +545,54 @@ def handle_finetune_llm(args):
     if not FINETUNE_DATASET_PATH.exists():
         print(f"ERROR: Dataset file not found at {FINETUNE_DATASET_PATH}")
         sys.exit(1)
-        
-    with open(FINETUNE_DATASET_PATH, 'r') as f:
-        data = json.load(f)
-
-    # Format data into a prompt template
-    def format_prompt(item):
-        return f"### Instruction:\n{item['instruction']}\n\n### Response:\n{item['response']}"
 
-    text_data = [format_prompt(item) for item in data]
-    dataset = Dataset.from_dict({"text": text_data})
+    # The dataset is tokenized once and cached; the cache is keyed on the
+    # tokenizer, the prompt format, the sequence length and the dataset contents.
+    dataset_digest = file_digest(FINETUNE_DATASET_PATH)
+    tokenizer_key = re.sub(r"[^A-Za-z0-9._-]+", "--", model_name).strip("-")
+    cache_dir = FINETUNE_CACHE_DIR / f"{tokenizer_key}-v{FINETUNE_CACHE_VERSION}-{FINETUNE_MAX_SEQ_LENGTH}-{dataset_digest[:16]}"
+    if cache_dir.exists():
+        print(f"Loading tokenized dataset from cache: {cache_dir}")
+        dataset = load_from_disk(str(cache_dir))
+    else:
+        # Format data into a prompt template. The dataset is tokenized here rather
+        # than by SFTTrainer, so the EOS token must be appended explicitly; it
+        # separates packed examples and teaches the model where to stop.
+        def format_prompt(item):
+            return f"### Instruction:\n{item['instruction']}\n\n### Response:\n{item['response']}{tokenizer.eos_token}"
+
+        # Stream the examples from the JSON array so large datasets are never
+        # fully loaded into memory. The path and digest are passed as generator
+        # arguments so they are part of the fingerprint `datasets` caches the
+        # generated data under; otherwise an edited file would reuse old data.
+        def generate_examples(path, digest):
+            with open(path, 'rb') as f:
+                for item in ijson.items(f, 'item'):
+                    yield {"text": format_prompt(item)}
+
+        dataset = Dataset.from_generator(
+            generate_examples,
+            gen_kwargs={"path": str(FINETUNE_DATASET_PATH), "digest": dataset_digest},
+        )
+        dataset = dataset.map(
+            lambda batch: tokenizer(batch["text"], truncation=True, max_length=FINETUNE_MAX_SEQ_LENGTH),
+            batched=True,
+            remove_columns=["text"],
+            num_proc=min(os.cpu_count() or 1, len(dataset)),
+        )
+
+        # Save through a temporary sibling so an interrupted run never leaves
+        # a partial cache that would be picked up by the next one.
+        tmp_cache_dir = cache_dir.with_name(cache_dir.name + ".tmp")
+        shutil.rmtree(tmp_cache_dir, ignore_errors=True)
+        dataset.save_to_disk(str(tmp_cache_dir))
+        os.replace(tmp_cache_dir, cache_dir)
 
     # 4. Configure and run Trainer
     output_dir = PROJECT_ROOT / "finetuned_models" / f"{Path(model_name).name}-lora-adapter"
     print(f"Training artifacts will be saved to: {output_dir}")
 
-    training_args = TrainingArguments(
+    training_args = SFTConfig(
         output_dir=str(output_dir),
         per_device_train_batch_size=args.batch_size,
         gradient_accumulation_steps=4,
@@ -263,14 +600,19 @@ def handle_finetune_llm(args):
         num_train_epochs=args.epochs,
         logging_steps=10,
         save_strategy="epoch",
-        fp16=True, # Use mixed precision
+        bf16=True, # Use mixed precision (Gemma is unstable in fp16)
+        gradient_checkpointing=True,
+        packing=use_packing, # Pack short examples together instead of padding them
+        packing_strategy="bfd", # Whole examples per sequence, each with its own position IDs
+        padding_free=use_packing, # Keep packed examples apart in FlashAttention-2
+        max_length=FINETUNE_MAX_SEQ_LENGTH,
     )
 
-    trainer = Trainer(
+    trainer = SFTTrainer(
         model=model,
         args=training_args,
         train_dataset=dataset,
-        data_collator=DataCollatorForLanguageModeling(tokenizer, mlm=False),
+        processing_class=tokenizer,
     )
 
     print("Starting fine-tuning process...")
@@ -293,6 +635,11 @@ def main():
     parser_add_face.add_argument("-s", "--samples", type=int, default=20, help="Number of face samples to collect.")
     parser_add_face.set_defaults(func=handle_add_face)
 
+    # Sub-parser for 'quantize-embedder'
+    parser_quantize = subparsers.add_parser("quantize-embedder", help="Quantize the face embedding model to INT8.")
+    parser_quantize.add_argument("calibration_dir", type=Path, help="Directory of face images used to calibrate the quantization.")
+    parser_quantize.set_defaults(func=handle_quantize_embedder)
+
     # Sub-parser for 'finetune-llm'
     parser_finetune = subparsers.add_parser("finetune-llm", help="Fine-tune the language model on a custom dataset.")
     parser_finetune.add_argument("--base-model", type=str, default="google/gemma-2b-it", help="The base Hugging Face model to fine-tune.")